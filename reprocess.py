@@ -0,0 +1,246 @@
+'''
+Offline reprocessing of recorded ultrasonic traces
+
+Runs the same cleaning, curve logging and speeding logic as system.py over a
+recorded trace and outputs the DIG records the live system would have sent.
+Traces are either a CSV with `distance` and `timestamp` columns or a `.npy`
+array of shape (n, 2) - one row per tick, in the order returned by sonar_read.
+'''
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+import json
+import sys
+
+
+import numpy as np
+import pandas as pd
+
+
+# Timing constants (must match system.py)
+CYCLE_TIME = 0.1
+POLL_COUNT_DISTANCE = 100
+
+# DIG constants and message codes (must match system.py)
+SERIAL_NO = 'CXF7216F55ED'
+ODOMETER_CODE = 5
+SPEEDING_CODE = 35307
+SPEEDING_ABOVE_MAX_CODE = 35308
+
+# Default thresholds used by the live loop
+SPIKE_LIMIT = 200
+SPEEDING_LIMIT = 10
+SPEEDING_MAX_LIMIT = 20
+SPEEDING_DEBOUNCE = 3
+CURVE_ERROR = 20
+
+# Number of logging windows handled per chunk
+WINDOWS_PER_CHUNK = 1000
+
+
+def read_trace(path, chunk_rows):
+    '''
+    Checks the trace file and returns a generator over blocks of [distance, timestamp] rows
+
+    Raises ValueError if the trace is not in the expected shape.
+    '''
+    if path.endswith('.npy'):
+        # Memory map so large traces are never fully loaded
+        trace = np.load(path, mmap_mode='r')
+        if trace.ndim != 2 or trace.shape[1] < 2:
+            raise ValueError(f'{path}: expected an array of shape (n, 2), got {trace.shape}')
+        return (np.asarray(trace[start:start + chunk_rows, :2], dtype=float)
+                for start in range(0, len(trace), chunk_rows))
+
+    missing = {'distance', 'timestamp'} - set(pd.read_csv(path, nrows=0).columns)
+    if missing:
+        raise ValueError(f'{path}: missing column(s) {", ".join(sorted(missing))}')
+    frames = pd.read_csv(path, usecols=['distance', 'timestamp'], chunksize=chunk_rows)
+    return (frame[['distance', 'timestamp']].to_numpy(dtype=float) for frame in frames)
+
+
+def aligned_chunks(blocks, chunk_size):
+    '''
+    Regroups blocks into chunks lined up with the live logging windows
+
+    Each chunk is prefixed with the last reading of the previous chunk so
+    speeding checks can look one tick back. Yields (tick of first row, rows).
+    '''
+    buffer = np.empty((0, 2))
+    offset = 0
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        while len(buffer) > chunk_size:
+            yield offset, buffer[:chunk_size + 1]
+            buffer = buffer[chunk_size:]
+            offset += chunk_size
+    if len(buffer) > 1:
+        yield offset, buffer
+
+
+def curve_logging_helper(values, timestamps, max_diffs, curve_error=CURVE_ERROR):
+    '''
+    Recursive helper function to find values with the maximum error (same as system.py)
+    '''
+    # Prevent divide by 0 error or having too many points sending through DIG
+    if len(values) == 1 or len(max_diffs) > POLL_COUNT_DISTANCE * CYCLE_TIME / 2:
+        return max_diffs
+
+    # "Draw" line between first and last point
+    slope = (values[-1] - values[0]) / (timestamps[-1] - timestamps[0])
+    y_int = values[0] - timestamps[0] * slope
+    preds = timestamps * slope + y_int
+
+    # Find point that is furthest from line
+    diffs = np.abs(values - preds)
+    i = np.argmax(diffs)
+
+    # If error is significant, add the point and keep logging
+    if (diffs[i]) > curve_error:
+        max_diffs.append([values[i], timestamps[i]])
+        max_diffs = curve_logging_helper(values[:i+1], timestamps[:i+1], max_diffs, curve_error)
+        max_diffs = curve_logging_helper(values[i:], timestamps[i:], max_diffs, curve_error)
+    return max_diffs
+
+
+def process_chunk(chunk, thresholds):
+    '''
+    Runs the speeding check and distance logging over one chunk
+
+    Returns the speeding candidates as (tick, timestamp, code) before the
+    debounce, and the odometer logs as (tick, distance, timestamp).
+    '''
+    offset, readings = chunk
+    distances = readings[:, 0]
+    timestamps = readings[:, 1]
+    ticks = offset + np.arange(len(readings))
+
+    # Speeding check between every reading and the one before it
+    v1, v0 = distances[1:], distances[:-1]
+    speeds = np.abs(v1 - v0)
+    speeding = (
+        (ticks[1:] >= 2)
+        & (v1 <= thresholds['spike_limit'])
+        & (v0 <= thresholds['spike_limit'])
+        & (speeds > thresholds['speeding_limit'])
+    )
+    codes = np.where(speeds > thresholds['speeding_max_limit'], SPEEDING_ABOVE_MAX_CODE, SPEEDING_CODE)
+    speeding_logs = np.column_stack([ticks[1:], timestamps[1:], codes])[speeding]
+
+    # Clean data for 0s and false spikes, same as distance_log_handler
+    valid = (timestamps != 0) & (distances < thresholds['spike_limit'])
+
+    # Distance is logged on every tick that is a multiple of the poll count
+    odometer_logs = []
+    for end in ticks[(ticks % POLL_COUNT_DISTANCE == 0) & (ticks != 0) & (ticks > offset)]:
+        window = slice(end - offset - POLL_COUNT_DISTANCE + 1, end - offset + 1)
+        window_distances = distances[window][valid[window]]
+        window_timestamps = timestamps[window][valid[window]]
+        if len(window_distances) < 3:
+            continue
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_data = curve_logging_helper(window_distances, window_timestamps, [], thresholds['curve_error'])
+        log_data.append([window_distances[-1], window_timestamps[-1]])
+        odometer_logs.extend((end, distance, timestamp) for distance, timestamp in log_data)
+
+    return speeding_logs, odometer_logs
+
+
+def make_record(serial_no, code, value, timestamp):
+    '''
+    Builds a GenericStatusRecord in the same format as dig_calls.send_GenericStatusRecord
+    '''
+    return {
+        "DateTime": datetime.fromtimestamp(timestamp).isoformat() + 'Z',
+        "SerialNo": serial_no,
+        "Type": 'GenericStatusRecord',
+        "Code": int(code),
+        "Value": int(value)
+        }
+
+
+def reprocess(chunks, thresholds, serial_no=SERIAL_NO, workers=1):
+    '''
+    Runs the pipeline over all chunks and returns the DIG records in send order
+    '''
+    worker = partial(process_chunk, thresholds=thresholds)
+    if workers > 1:
+        # Only keep a few chunks pending so the trace is still streamed
+        results = []
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk in chunks:
+                if len(pending) >= 2 * workers:
+                    results.append(pending.popleft().result())
+                pending.append(executor.submit(worker, chunk))
+            while pending:
+                results.append(pending.popleft().result())
+    else:
+        results = [worker(chunk) for chunk in chunks]
+
+    # Speeding debounce depends on the previous log, so it runs in order across chunks
+    last_speeding = 0
+    logs = []
+    for speeding_logs, odometer_logs in results:
+        for tick, t1, code in speeding_logs:
+            if t1 - last_speeding > thresholds['speeding_debounce']:
+                last_speeding = t1
+                logs.append((tick, 0, make_record(serial_no, code, 1, t1)))
+        for tick, distance, timestamp in odometer_logs:
+            logs.append((tick, 1, make_record(serial_no, ODOMETER_CODE, distance * 10, timestamp)))
+
+    # Within a tick the live loop checks speeding before logging distance
+    logs.sort(key=lambda log: log[:2])
+    return [log[2] for log in logs]
+
+
+def main(argv=None):
+    '''
+    Command line entry point
+    '''
+    parser = argparse.ArgumentParser(description='Reprocess recorded ultrasonic traces into DIG records')
+    parser.add_argument('trace', help='CSV (distance, timestamp columns) or .npy trace file')
+    parser.add_argument('-o', '--output', help='file to write the JSON records to (default: stdout)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--windows-per-chunk', type=int, default=WINDOWS_PER_CHUNK,
+                        help='logging windows of %d readings per chunk' % POLL_COUNT_DISTANCE)
+    parser.add_argument('--serial-no', default=SERIAL_NO)
+    parser.add_argument('--spike-limit', type=float, default=SPIKE_LIMIT)
+    parser.add_argument('--speeding-limit', type=float, default=SPEEDING_LIMIT)
+    parser.add_argument('--speeding-max-limit', type=float, default=SPEEDING_MAX_LIMIT)
+    parser.add_argument('--speeding-debounce', type=float, default=SPEEDING_DEBOUNCE)
+    parser.add_argument('--curve-error', type=float, default=CURVE_ERROR)
+    args = parser.parse_args(argv)
+
+    if args.workers < 1 or args.windows_per_chunk < 1:
+        parser.error('--workers and --windows-per-chunk must be at least 1')
+
+    thresholds = {
+        'spike_limit': args.spike_limit,
+        'speeding_limit': args.speeding_limit,
+        'speeding_max_limit': args.speeding_max_limit,
+        'speeding_debounce': args.speeding_debounce,
+        'curve_error': args.curve_error,
+    }
+    chunk_size = args.windows_per_chunk * POLL_COUNT_DISTANCE
+    try:
+        blocks = read_trace(args.trace, chunk_size)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    chunks = aligned_chunks(blocks, chunk_size)
+    records = reprocess(chunks, thresholds, args.serial_no, args.workers)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(records, file, indent=4)
+    else:
+        json.dump(records, sys.stdout, indent=4)
+        print()
+    print(f'{len(records)} records generated', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()